@@ -1,33 +1,334 @@
+import asyncio
+import contextlib
+import functools
+import importlib.util
 import json
 import re
-from typing import Dict, Any, List
-from transformers import pipeline
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Any, AsyncIterator, Callable, List, NamedTuple, Optional, Tuple
+
+if TYPE_CHECKING:
+    import torch
+
+try:
+    # Optional single-pass keyphrase matcher for the rule-based summary
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class DialogueSplit(NamedTuple):
+    """The parts of a transcript the analysis tasks work from."""
+    patient: Tuple[str, ...]
+    physician: Tuple[str, ...]
+    objective: str
+
 
 class PhysicianNotetakerPipeline:
     """
     A unified pipeline that runs a full analysis on a medical transcript,
     producing a structured summary, sentiment analysis, and a dynamic SOAP note.
     """
-    def __init__(self):
+    # The SOAP note skeleton: (section, field, context source, point name, point description)
+    # for every field generated by the LLM, in point order
+    _SOAP_SKELETON = [
+        ("Subjective", "Chief_Complaint", "patient", "Chief Complaint", "The primary symptoms the patient reports, such as pain."),
+        ("Subjective", "History_of_Present_Illness", "patient", "History of Present Illness", "The patient's story of the accident and the progression of their symptoms over time."),
+        ("Assessment", "Diagnosis", "physician", "Diagnosis", "The medical diagnosis given by the physician, such as 'whiplash injury'."),
+        ("Assessment", "Prognosis", "physician", "Prognosis", "The physician's forecast for the patient's recovery."),
+        ("Plan", "Treatment", "both", "Treatment Plan", "The treatments mentioned, such as physiotherapy or painkillers."),
+        ("Plan", "Follow-Up", "physician", "Follow-Up Plan", "Instructions for future appointments or actions if symptoms worsen.")
+    ]
+
+    # Shared by every SOAP prompt; kept byte-identical so vLLM's prefix cache can reuse
+    # it when soap_model is decoder-only (vLLM does not prefix-cache encoder-decoders)
+    _SOAP_PROMPT_PREAMBLE = (
+        "You are expanding the skeleton of a SOAP note one point at a time. Skeleton: "
+        + "; ".join(f"{point}. {spec[3]}" for point, spec in enumerate(_SOAP_SKELETON, 1)) + ". "
+        "Based *only* on the following context, expand the requested point into one brief, "
+        'professional sentence. If the information is not present in the context, respond with "Not mentioned".\n\n'
+    )
+
+    # Summary rules as (lowercase keyphrases, summary field, value, regex for non-literal forms).
+    # List fields are appended to, the others are set; rules apply in this order.
+    _SUMMARY_RULES = [
+        (("pain in my neck", "neck pain"), "Symptoms", "Neck pain", None),
+        (("back pain",), "Symptoms", "Back pain", re.compile(r"pain in my.+back", re.IGNORECASE)),
+        (("hit my head",), "Symptoms", "Head impact", None),
+        (("whiplash injury",), "Diagnosis", "Whiplash injury", None),
+        (("ten sessions of physiotherapy",), "Treatment", "10 physiotherapy sessions", None),
+        (("painkillers",), "Treatment", "Painkillers", None),
+        (("occasional backaches",), "Current_Status", "Occasional backaches", None),
+        (("full recovery within six months",), "Prognosis", "Full recovery expected within six months", None),
+    ]
+
+    # SOAP generation models by quality setting
+    SOAP_MODELS = {"fast": "google/flan-t5-base", "high": "google/flan-t5-large"}
+
+    SENTIMENT_LABELS = ["Anxious", "Neutral", "Reassured", "Concerned"]
+    INTENT_LABELS = ["Seeking reassurance", "Reporting symptoms", "Expressing relief"]
+
+    # SOAP fields that can be answered from the rule-based medical summary
+    _SOAP_SUMMARY_FIELDS = {
+        ("Subjective", "Chief_Complaint"): "Symptoms",
+        ("Assessment", "Diagnosis"): "Diagnosis",
+        ("Assessment", "Prognosis"): "Prognosis",
+        ("Plan", "Treatment"): "Treatment",
+    }
+
+    # Precompiled once at class load instead of re-parsed on every call
+    _PATTERNS = {
+        "patient": re.compile(r"Patient:\s*(.*)", re.IGNORECASE),
+        "physician": re.compile(r"Physician:\s*(.*)", re.IGNORECASE),
+        "physical_exam": re.compile(r"\[Physical Examination Conducted\](.*)", re.DOTALL),
+        "expressive": re.compile(r"worried|scared|relief|great|rough", re.IGNORECASE),
+    }
+
+    def __init__(self, soap_model: Optional[str] = None, quality: str = "fast",
+                 soap_backend: str = "transformers", num_beams: int = 2, compile_models: bool = False,
+                 quantize: Optional[str] = None, share_encoder: bool = False):
         """
-        Initializes and loads all the necessary AI models.
-        This is done once to ensure efficient processing of multiple transcripts.
+        Configures the pipeline. The AI models are loaded lazily, once, on first
+        use, so multiple transcripts are processed efficiently and the rule-based
+        summary works without loading any model.
+
+        soap_model names the instruction-tuned model used for SOAP generation. When
+        it is not given, quality picks one: "fast" (flan-t5-base, the default) or
+        "high" (flan-t5-large, slower but stronger on unusual transcripts).
+        soap_backend selects the engine used for SOAP generation: "transformers"
+        (the default Hugging Face pipeline), "vllm" (PagedAttention with
+        continuous batching, requires the optional `vllm` package, a GPU and a
+        vLLM-supported soap_model, since vLLM cannot run flan-t5) or
+        "vllm-async" (vLLM's async engine, which finishes each field independently
+        so astream_soap_fields can yield fields as soon as they are done).
+        num_beams sets the beam width for SOAP generation; 1 switches to greedy
+        decoding for the lowest latency. The vLLM backends always decode greedily.
+        compile_models runs the PyTorch models through torch.compile when they are
+        loaded; the first calls are slower while kernels compile, later ones faster.
+        An int8-quantized SOAP model is left uncompiled.
+        quantize="int8" loads the SOAP model with 8-bit weights (bitsandbytes on GPU,
+        dynamic int8 quantization on CPU) to cut memory traffic while decoding.
+        share_encoder encodes each distinct SOAP context once and reuses it for every
+        field over that context, passing the field instructions to the decoder instead.
+        flan-t5 was trained with its instructions in the encoder input, so output
+        quality may drop with share_encoder; compare notes before relying on it.
         """
-        print("Initializing models... This may take a moment.")
-        print("Using a powerful model for SOAP notes, so the first run may be slow.")
+        if quality not in self.SOAP_MODELS:
+            raise ValueError(f"Unknown quality setting: {quality!r}")
+        if soap_backend not in ("transformers", "vllm", "vllm-async"):
+            raise ValueError(f"Unknown SOAP backend: {soap_backend!r}")
+        if isinstance(num_beams, bool) or not isinstance(num_beams, int) or num_beams < 1:
+            raise ValueError(f"num_beams must be a positive integer, got {num_beams!r}")
+        if quantize not in (None, "int8"):
+            raise ValueError(f"Unknown quantization: {quantize!r}")
+        if quantize and soap_backend != "transformers":
+            raise ValueError("quantize is only supported with the 'transformers' SOAP backend")
+        if share_encoder and soap_backend != "transformers":
+            raise ValueError("share_encoder is only supported with the 'transformers' SOAP backend")
+        # The vLLM backends decode greedily (see soap_sampling_params), so a wider beam would be ignored
+        if num_beams not in (1, 2) and soap_backend != "transformers":
+            raise ValueError("num_beams is only supported with the 'transformers' SOAP backend")
+        # vLLM is an optional high-throughput serving backend for SOAP generation
+        if soap_backend.startswith("vllm") and importlib.util.find_spec("vllm") is None:
+            raise ImportError(f"The {soap_backend!r} backend requires the vllm package: pip install vllm")
+        # vLLM does not support the T5 architecture of the default flan-t5 models
+        if soap_backend.startswith("vllm") and (soap_model is None or soap_model in self.SOAP_MODELS.values()):
+            raise ValueError(
+                f"The {soap_backend!r} backend cannot serve flan-t5; pass a vLLM-supported model via soap_model="
+            )
+        self.soap_model = soap_model or self.SOAP_MODELS[quality]
+        self.soap_backend = soap_backend
+        # Each skeleton point expands to one sentence: a narrow beam and no repeated trigrams
+        self.soap_generation_kwargs = {"max_new_tokens": 60, "num_beams": num_beams, "no_repeat_ngram_size": 3}
+        if num_beams > 1:
+            self.soap_generation_kwargs["early_stopping"] = True
+        self.compile_models = compile_models
+        self.quantize = quantize
+        self.share_encoder = share_encoder
+        self._summary_automaton = self._build_summary_automaton()
 
-        # Model for fast and flexible Sentiment/Intent analysis
-        self.zero_shot_classifier = pipeline(
-            "zero-shot-classification", model="facebook/bart-large-mnli"
-        )
+    # Models are loaded on first use, so summary-only callers never import
+    # transformers or pay for multiple GB of weights and startup time
+    @functools.cached_property
+    def sentence_encoder(self):
+        """Small sentence encoder for fast and flexible Sentiment/Intent analysis."""
+        from sentence_transformers import SentenceTransformer
 
-        # A powerful instruction-tuned model for the complex SOAP note generation
-        self.soap_generator = pipeline(
-            "text2text-generation", model="google/flan-t5-large"
-        )
-        print(" Models initialized successfully.")
+        print("Initializing sentiment model... This may take a moment.")
+        encoder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        if self.compile_models:
+            self._compile_forward(encoder[0].auto_model)
+        return encoder
+
+    @functools.cached_property
+    def _label_embeddings(self):
+        """Unit-length embeddings of SENTIMENT_LABELS + INTENT_LABELS, computed once."""
+        return self.sentence_encoder.encode(self.SENTIMENT_LABELS + self.INTENT_LABELS, normalize_embeddings=True)
+
+    @functools.cached_property
+    def soap_generator(self):
+        """
+        An instruction-tuned model for the complex SOAP note generation. Its precision
+        depends on the path: fp16 on vLLM, int8 weights with quantize="int8", and
+        otherwise bf16/fp16 on GPU or fp32 on CPU.
+        """
+        print(f"Initializing {self.soap_model} for SOAP notes... The first run may be slow.")
+        if self.soap_backend.startswith("vllm"):
+            from vllm import LLM
+
+            print(f"Running SOAP generation on {self.soap_backend}.")
+            vllm_kwargs = {
+                "model": self.soap_model, "dtype": "float16", "gpu_memory_utilization": 0.8,
+                "enable_prefix_caching": True
+            }
+            if self.soap_backend == "vllm-async":
+                # Built on the engine loop so every task the engine starts is bound to that loop
+                return asyncio.run_coroutine_threadsafe(
+                    self._create_async_engine(vllm_kwargs), self._engine_loop
+                ).result()
+            return LLM(**vllm_kwargs)
+
+        from transformers import pipeline
+
+        if self.quantize == "int8":
+            generator = self._load_int8_generator()
+        else:
+            device, dtype = self._select_device_and_dtype()
+            print(f"Running SOAP generation on {'GPU' if device == 0 else 'CPU'} with {dtype}.")
+            generator = pipeline("text2text-generation", model=self.soap_model, torch_dtype=dtype, device=device)
+        # torch.compile does not trace through the int8 kernels of quantized Linear layers
+        if self.compile_models and self.quantize != "int8":
+            self._compile_forward(generator.model)
+        return generator
+
+    def _load_int8_generator(self):
+        """
+        Helper that builds the SOAP pipeline around an 8-bit model: bitsandbytes int8
+        weights on GPU, or PyTorch dynamic int8 quantization of the Linear layers on CPU,
+        where decoding is memory-bound.
+        """
+        import torch
+        from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, pipeline
+
+        tokenizer = AutoTokenizer.from_pretrained(self.soap_model)
+        if torch.cuda.is_available():
+            from transformers import BitsAndBytesConfig
+
+            print("Running SOAP generation on GPU with bitsandbytes int8 weights.")
+            model = AutoModelForSeq2SeqLM.from_pretrained(
+                self.soap_model, quantization_config=BitsAndBytesConfig(load_in_8bit=True), device_map="auto"
+            )
+        else:
+            print("Running SOAP generation on CPU with dynamic int8 quantization.")
+            model = AutoModelForSeq2SeqLM.from_pretrained(self.soap_model, torch_dtype=torch.float32)
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return pipeline("text2text-generation", model=model, tokenizer=tokenizer)
+
+    @functools.cached_property
+    def soap_sampling_params(self):
+        """Sampling settings for the vLLM backends."""
+        from vllm import SamplingParams
+
+        # vLLM no longer exposes beam search through SamplingParams, so decode greedily
+        return SamplingParams(max_tokens=self.soap_generation_kwargs["max_new_tokens"], temperature=0.0)
+
+    @functools.cached_property
+    def _chat_tokenizer(self):
+        """Tokenizer of the vLLM soap_model, used only to apply its chat template."""
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(self.soap_model)
+
+    def _apply_chat_template(self, prompts: List[str]) -> List[str]:
+        """
+        Helper that wraps each prompt as a user turn in the soap_model's chat template,
+        the input format chat models were trained on. Models without one get the raw prompt.
+        """
+        tokenizer = self._chat_tokenizer
+        if not getattr(tokenizer, "chat_template", None):
+            return prompts
+        return [
+            tokenizer.apply_chat_template([{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True)
+            for prompt in prompts
+        ]
+
+    @functools.cached_property
+    def _engine_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        The async engine is bound to one event loop, so it gets a dedicated one
+        that both sync and async callers submit requests to.
+        """
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        return loop
+
+    @staticmethod
+    async def _create_async_engine(vllm_kwargs: Dict[str, Any]):
+        """Helper that builds the async engine from within the running engine loop."""
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**vllm_kwargs))
+
+    @staticmethod
+    def _compile_forward(model) -> None:
+        """
+        Helper that compiles a model's forward pass in place. The module itself is left
+        unwrapped, so generate() and encode(), which call forward internally, use the
+        compiled kernels. The default mode is used: CUDA graphs ("reduce-overhead")
+        would be re-recorded as the KV cache grows and are kept per thread, while the
+        tasks in run_full_analysis run on separate threads.
+        """
+        import torch
+
+        if not hasattr(torch, "compile"):
+            print("torch.compile requires PyTorch 2.0 or newer; running the models eagerly.")
+            return
+        model.forward = torch.compile(model.forward, fullgraph=False, dynamic=True)
+
+    @staticmethod
+    def _select_device_and_dtype() -> Tuple[int, "torch.dtype"]:
+        """
+        Picks the device and precision for the generator: half precision on GPU
+        (bf16 where the card supports it, since T5 can overflow in fp16) and full
+        fp32 on CPU, where PyTorch has no public check for native bf16 support.
+        """
+        import torch
+
+        if torch.cuda.is_available():
+            return 0, torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return -1, torch.float32
 
     ### --- Task 1: Medical NLP Summarization (High-Precision Rules) --- ###
+    @classmethod
+    def _build_summary_automaton(cls):
+        """Builds an Aho-Corasick automaton over all summary keyphrases, if pyahocorasick is installed."""
+        if ahocorasick is None:
+            return None
+        automaton = ahocorasick.Automaton()
+        for rule_index, (keyphrases, _, _, _) in enumerate(cls._SUMMARY_RULES):
+            for keyphrase in keyphrases:
+                automaton.add_word(keyphrase, rule_index)
+        automaton.make_automaton()
+        return automaton
+
+    def _match_summary_rules(self, transcript: str) -> List[int]:
+        """Helper that returns the indices of all summary rules matched by the transcript."""
+        transcript_lower = transcript.lower()
+        if self._summary_automaton is not None:
+            # One O(n) sweep over the transcript for every keyphrase at once
+            matched = {rule_index for _, rule_index in self._summary_automaton.iter(transcript_lower)}
+        else:
+            matched = {
+                rule_index for rule_index, (keyphrases, _, _, _) in enumerate(self._SUMMARY_RULES)
+                if any(keyphrase in transcript_lower for keyphrase in keyphrases)
+            }
+        for rule_index, (_, _, _, pattern) in enumerate(self._SUMMARY_RULES):
+            if pattern is not None and rule_index not in matched and pattern.search(transcript):
+                matched.add(rule_index)
+        return sorted(matched)
+
     def generate_medical_summary(self, transcript: str) -> Dict[str, Any]:
         """
         Generates a structured medical summary using a precise, rule-based
@@ -43,14 +344,12 @@ class PhysicianNotetakerPipeline:
             "Prognosis": "Not mentioned"
         }
         # Refined rule-based extraction logic
-        if re.search(r"pain in my neck|neck pain", transcript, re.IGNORECASE): summary["Symptoms"].append("Neck pain")
-        if re.search(r"pain in my.+back|back pain", transcript, re.IGNORECASE): summary["Symptoms"].append("Back pain")
-        if re.search(r"hit my head", transcript, re.IGNORECASE): summary["Symptoms"].append("Head impact")
-        if "whiplash injury" in transcript.lower(): summary["Diagnosis"] = "Whiplash injury"
-        if "ten sessions of physiotherapy" in transcript.lower(): summary["Treatment"].append("10 physiotherapy sessions")
-        if "painkillers" in transcript.lower(): summary["Treatment"].append("Painkillers")
-        if "occasional backaches" in transcript.lower(): summary["Current_Status"] = "Occasional backaches"
-        if "full recovery within six months" in transcript.lower(): summary["Prognosis"] = "Full recovery expected within six months"
+        for rule_index in self._match_summary_rules(transcript):
+            _, field, value, _ = self._SUMMARY_RULES[rule_index]
+            if isinstance(summary[field], list):
+                summary[field].append(value)
+            else:
+                summary[field] = value
         return summary
 
     ### --- Task 2: Sentiment & Intent Analysis (Targeted Classification) --- ###
@@ -60,86 +359,318 @@ class PhysicianNotetakerPipeline:
         statement and classifies its sentiment and intent.
         """
         print("2/3: Analyzing Patient Sentiment...")
-        patient_lines = re.findall(r"Patient:\s*(.*)", transcript, re.IGNORECASE)
+        patient_lines = self._split_dialogue(transcript).patient
         if not patient_lines:
             return {"Error": "No patient dialogue found."}
 
         # Find the most expressive line to analyze
         expressive_line = patient_lines[-1] # Default to the last line
         for line in patient_lines:
-            if any(word in line.lower() for word in ["worried", "scared", "relief", "great", "rough"]):
+            if self._PATTERNS["expressive"].search(line):
                 expressive_line = line
                 break
         
-        sentiment = self.zero_shot_classifier(expressive_line, candidate_labels=["Anxious", "Neutral", "Reassured", "Concerned"])['labels'][0]
-        intent = self.zero_shot_classifier(expressive_line, candidate_labels=["Seeking reassurance", "Reporting symptoms", "Expressing relief"])['labels'][0]
+        # One encoder pass for the line, then cosine similarity against the precomputed labels
+        line_embedding = self.sentence_encoder.encode(expressive_line, normalize_embeddings=True)
+        scores = self._label_embeddings @ line_embedding
+        num_sentiments = len(self.SENTIMENT_LABELS)
+        sentiment = self.SENTIMENT_LABELS[int(scores[:num_sentiments].argmax())]
+        intent = self.INTENT_LABELS[int(scores[num_sentiments:].argmax())]
         return {"Analyzed_Line": expressive_line.strip(), "Sentiment": sentiment, "Intent": intent}
 
     ### --- Task 3: SOAP Note Generation (Advanced AI Summarization) --- ###
-    def _get_dialogue_by_speaker(self, transcript: str, speaker: str) -> str:
-        """Helper to extract all lines for a specific speaker."""
-        lines = re.findall(rf"{speaker}:\s*(.*)", transcript, re.IGNORECASE)
-        return " ".join(lines)
-
-    def _get_soap_field(self, context: str, field_name: str, field_description: str) -> str:
-        """Helper function that queries the LLM with a highly specific, targeted prompt."""
-        if not context.strip():
-            return "Not mentioned in the provided context."
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def _split_dialogue(cls, transcript: str) -> DialogueSplit:
+        """
+        Helper that splits a transcript into patient lines, physician lines and the
+        text after the physical exam marker. Cached, so the tasks sharing a transcript
+        (and repeated transcripts in batch runs) only scan it once.
+        """
+        # Context for Objective is usually after the physical exam is mentioned
+        objective_context = cls._PATTERNS["physical_exam"].search(transcript)
+        return DialogueSplit(
+            patient=tuple(cls._PATTERNS["patient"].findall(transcript)),
+            physician=tuple(cls._PATTERNS["physician"].findall(transcript)),
+            objective=objective_context.group(1).strip() if objective_context else ""
+        )
 
-        prompt = f"""
-        Based *only* on the following text, provide a concise summary for the "{field_name}".
-        The "{field_name}" is: {field_description}.
-        Summarize the key points into a brief, professional statement. If the information is not present in the text, respond with "Not mentioned".
+    def _build_prompt(self, point: int, point_name: str, point_description: str, context: str) -> Tuple[str, str]:
+        """
+        Helper that builds a Skeleton-of-Thought style prompt asking the LLM to expand a
+        single point of the SOAP skeleton, returned as (context part, field part); the
+        full prompt is their concatenation.
+        The invariant instructions come first and the field-specific part last, so
+        every prompt shares the same prefix (and prompts over the same context share
+        the whole context part). vLLM's prefix cache reuses that prefix only for a
+        decoder-only soap_model; for flan-t5, share_encoder reuses the context part.
+        """
+        return (
+            f'{self._SOAP_PROMPT_PREAMBLE}Context: "{context}"\n\n',
+            f"Point {point}: {point_name}. {point_description}\nExpand to one sentence:"
+        )
 
-        TEXT: "{context}"
+    def _generate(self, prompt_parts: List[Tuple[str, str]]) -> List[str]:
+        """Helper that runs a batch of prompts through the configured SOAP backend."""
+        prompts = ["".join(parts) for parts in prompt_parts]
+        if self.share_encoder:
+            texts = self._generate_with_shared_encoder(prompt_parts)
+        elif self.soap_backend == "vllm-async":
+            texts = [future.result() for future in self._submit_async(prompts)]
+        elif self.soap_backend == "vllm":
+            outputs = self.soap_generator.generate(self._apply_chat_template(prompts), self.soap_sampling_params)
+            texts = [output.outputs[0].text for output in outputs]
+        else:
+            outputs = self.soap_generator(prompts, batch_size=8, **self.soap_generation_kwargs)
+            texts = [output['generated_text'] for output in outputs]
+        return [text.strip().strip('"') for text in texts]
 
-        Summary of {field_name}:
+    def _generate_with_shared_encoder(self, prompt_parts: List[Tuple[str, str]]) -> List[str]:
+        """
+        Helper that encodes each unique context part once and decodes every field over
+        that context in one batch. The field parts become left-padded decoder prefixes,
+        so only the decoder runs per field and there is one generate call per context.
         """
-        response = self.soap_generator(prompt, max_new_tokens=150, num_beams=4, early_stopping=True)[0]['generated_text']
-        return response.strip().strip('"')
+        import torch
+        from transformers.modeling_outputs import BaseModelOutput
+
+        model, tokenizer = self.soap_generator.model, self.soap_generator.tokenizer
+        # Group the fields by context, remembering each field's position in the results
+        fields_by_context: Dict[str, List[Tuple[int, str]]] = {}
+        for index, (context_prompt, field_prompt) in enumerate(prompt_parts):
+            fields_by_context.setdefault(context_prompt, []).append((index, field_prompt))
+
+        texts = [""] * len(prompt_parts)
+        with torch.inference_mode():
+            for context_prompt, fields in fields_by_context.items():
+                inputs = tokenizer(context_prompt, return_tensors="pt").to(model.device)
+                hidden_state = model.get_encoder()(
+                    input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]
+                ).last_hidden_state
+                # One decoder row per field, all attending to the same encoder states
+                hidden_state = hidden_state.repeat(len(fields), 1, 1)
+                attention_mask = inputs["attention_mask"].repeat(len(fields), 1)
+
+                prefixes = [
+                    [model.config.decoder_start_token_id] + tokenizer(field_prompt, add_special_tokens=False).input_ids
+                    for _, field_prompt in fields
+                ]
+                prefix_len = max(len(prefix) for prefix in prefixes)
+                # Left-padded so every row's prefix ends where generation begins
+                decoder_input_ids = torch.tensor(
+                    [[tokenizer.pad_token_id] * (prefix_len - len(prefix)) + prefix for prefix in prefixes],
+                    device=model.device
+                )
+                decoder_attention_mask = torch.tensor(
+                    [[0] * (prefix_len - len(prefix)) + [1] * len(prefix) for prefix in prefixes],
+                    device=model.device
+                )
+                output_ids = model.generate(
+                    # A fresh wrapper per call, since generate() expands it in place for beam search
+                    encoder_outputs=BaseModelOutput(last_hidden_state=hidden_state),
+                    attention_mask=attention_mask,
+                    decoder_input_ids=decoder_input_ids,
+                    decoder_attention_mask=decoder_attention_mask,
+                    **self.soap_generation_kwargs
+                )
+                for (index, _), row in zip(fields, output_ids[:, prefix_len:]):
+                    texts[index] = tokenizer.decode(row, skip_special_tokens=True)
+        return texts
 
-    def generate_soap_note(self, transcript: str) -> Dict[str, Any]:
+    def _submit_async(self, prompts: List[str]) -> List[Future]:
+        """Helper that schedules each prompt as an independent request on the async engine's loop."""
+        # Loaded here rather than on the engine loop, which the load itself waits on
+        engine = self.soap_generator
+        return [
+            asyncio.run_coroutine_threadsafe(self._agenerate_one(engine, prompt), self._engine_loop)
+            for prompt in self._apply_chat_template(prompts)
+        ]
+
+    async def _agenerate_one(self, engine, prompt: str) -> str:
+        """Helper that runs one prompt on the async engine and returns its final text."""
+        final_output = None
+        async for output in engine.generate(prompt, self.soap_sampling_params, uuid.uuid4().hex):
+            final_output = output
+        if final_output is None:
+            raise RuntimeError("The async SOAP engine finished a request without producing any output")
+        return final_output.outputs[0].text
+
+    async def _agenerate_fields(self, prompts: List[Tuple[str, str, Tuple[str, str]]]) -> AsyncIterator[Tuple[str, str, str]]:
+        """Helper that yields (section, field, text) for each prompt as soon as its generation finishes."""
+        if not prompts:
+            return
+        if self.soap_backend != "vllm-async":
+            # Batched backends finish every field together; run the batch off the event loop
+            texts = await asyncio.get_running_loop().run_in_executor(None, self._generate, [p[2] for p in prompts])
+            for (section, field, _), text in zip(prompts, texts):
+                yield section, field, text
+            return
+        # Submitted from a worker thread: the first call loads the engine, which must
+        # neither block this loop nor run on the engine loop it waits for
+        futures = await asyncio.get_running_loop().run_in_executor(
+            None, self._submit_async, ["".join(p[2]) for p in prompts]
+        )
+        pending = {
+            asyncio.wrap_future(future): (section, field)
+            for (section, field, _), future in zip(prompts, futures)
+        }
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    section, field = pending.pop(task)
+                    yield section, field, task.result().strip().strip('"')
+        finally:
+            # The consumer stopped early or a request failed: cancelling a wrapped future
+            # cancels its coroutine on the engine loop, which aborts the engine request
+            for task in pending:
+                task.cancel()
+
+    def _extract_exam_findings(self, objective_text: str, max_chars: int = 400) -> str:
         """
-        Generates a structured SOAP note by running targeted AI summarizations
-        on the most relevant parts of the conversation for each field.
+        Helper that extracts the physical exam findings directly from the text after
+        the exam marker: the physician's first statement, which reports the findings.
+        """
+        if not objective_text:
+            return "Not mentioned in the provided context."
+        exam_lines = self._PATTERNS["physician"].findall(objective_text)
+        findings = (exam_lines[0] if exam_lines else objective_text).strip()
+        if len(findings) > max_chars:
+            findings = findings[:max_chars].rsplit(" ", 1)[0] + "..."
+        return findings
+
+    def _summary_shortcut(self, summary: Dict[str, Any], summary_field: str) -> Optional[str]:
+        """Helper that returns a deterministic summary value for a SOAP field, or None if it is unknown."""
+        value = summary.get(summary_field)
+        if isinstance(value, list):
+            return ", ".join(value) if value else None
+        return value if value and value != "Not mentioned" else None
+
+    def _plan_soap_note(self, transcript: str, summary: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[Tuple[str, str, Tuple[str, str]]]]:
+        """
+        Helper that fills every SOAP field that needs no LLM and returns the note
+        together with (section, field, prompt parts) entries for the fields still to generate.
         """
         print("3/3: Generating Dynamic SOAP Note (this may take a moment)...")
 
-        patient_dialogue = self._get_dialogue_by_speaker(transcript, "Patient")
-        physician_dialogue = self._get_dialogue_by_speaker(transcript, "Physician")
-        
-        # Context for Objective is usually after the physical exam is mentioned
-        objective_context = re.search(r"\[Physical Examination Conducted\](.*)", transcript, re.DOTALL)
-        objective_text = objective_context.group(1).strip() if objective_context else ""
+        dialogue = self._split_dialogue(transcript)
+        patient_dialogue = " ".join(dialogue.patient)
+        physician_dialogue = " ".join(dialogue.physician)
+        objective_text = dialogue.objective
+        contexts = {
+            "patient": patient_dialogue,
+            "physician": physician_dialogue,
+            "both": patient_dialogue + physician_dialogue
+        }
 
         soap_note = {
-            "Subjective": {
-                "Chief_Complaint": self._get_soap_field(patient_dialogue, "Chief Complaint", "The primary symptoms the patient reports, such as pain."),
-                "History_of_Present_Illness": self._get_soap_field(patient_dialogue, "History of Present Illness", "The patient's story of the accident and the progression of their symptoms over time.")
-            },
+            "Subjective": {"Chief_Complaint": None, "History_of_Present_Illness": None},
             "Objective": {
-                "Physical_Exam": self._get_soap_field(objective_text, "Physical Exam Findings", "The physician's objective findings from the physical examination."),
+                # The findings are a span of the text itself, so they are extracted rather than generated
+                "Physical_Exam": self._extract_exam_findings(objective_text),
                 "Observations": "Patient is alert and oriented, recounts events clearly." # A reasonable default observation
             },
-            "Assessment": {
-                "Diagnosis": self._get_soap_field(physician_dialogue, "Diagnosis", "The medical diagnosis given by the physician, such as 'whiplash injury'."),
-                "Prognosis": self._get_soap_field(physician_dialogue, "Prognosis", "The physician's forecast for the patient's recovery.")
-            },
-            "Plan": {
-                "Treatment": self._get_soap_field(patient_dialogue + physician_dialogue, "Treatment Plan", "The treatments mentioned, such as physiotherapy or painkillers."),
-                "Follow-Up": self._get_soap_field(physician_dialogue, "Follow-Up Plan", "Instructions for future appointments or actions if symptoms worsen.")
-            }
+            "Assessment": {"Diagnosis": None, "Prognosis": None},
+            "Plan": {"Treatment": None, "Follow-Up": None}
         }
+
+        # Fields without any context or with a rule-based answer are filled directly; the
+        # remaining skeleton points are expanded in parallel as one batch
+        prompts = []
+        for point, (section, field, context_source, point_name, point_description) in enumerate(self._SOAP_SKELETON, 1):
+            context = contexts[context_source]
+            summary_field = self._SOAP_SUMMARY_FIELDS.get((section, field))
+            shortcut = self._summary_shortcut(summary, summary_field) if summary and summary_field else None
+            if shortcut:
+                soap_note[section][field] = shortcut
+            elif not context.strip():
+                soap_note[section][field] = "Not mentioned in the provided context."
+            else:
+                prompts.append((section, field, self._build_prompt(point, point_name, point_description, context)))
+
+        return soap_note, prompts
+
+    def generate_soap_note(self, transcript: str, summary: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Generates a structured SOAP note by running targeted AI summarizations
+        on the most relevant parts of the conversation for each field.
+        All field prompts are sent to the LLM as a single batch.
+        If a medical summary is given, fields it already answers are filled from
+        it directly and only the remaining ones are sent to the LLM.
+        """
+        soap_note, prompts = self._plan_soap_note(transcript, summary)
+        if prompts:
+            outputs = self._generate([p[2] for p in prompts])
+            for (section, field, _), output in zip(prompts, outputs):
+                soap_note[section][field] = output
+        return soap_note
+
+    async def astream_soap_fields(self, transcript: str, summary: Optional[Dict[str, Any]] = None) -> AsyncIterator[Tuple[str, str, str]]:
+        """
+        Streams the SOAP note as (section, field, text) tuples. Fields that need no
+        LLM come first; generated fields follow as each one completes, so with the
+        "vllm-async" backend a short field is not held up by the longest one.
+        Closing the stream early cancels the generations still running.
+        """
+        soap_note, prompts = self._plan_soap_note(transcript, summary)
+        for section, fields in soap_note.items():
+            for field, value in fields.items():
+                if value is not None:
+                    yield section, field, value
+        generated_fields = self._agenerate_fields(prompts)
+        try:
+            async for section, field, text in generated_fields:
+                yield section, field, text
+        finally:
+            await generated_fields.aclose()
+
+    async def agenerate_soap_note(self, transcript: str, summary: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Async variant of generate_soap_note; callers without a running loop can use asyncio.run()."""
+        soap_note, prompts = self._plan_soap_note(transcript, summary)
+        async for section, field, text in self._agenerate_fields(prompts):
+            soap_note[section][field] = text
         return soap_note
 
     ### --- Main Execution Method --- ###
+    @functools.cached_property
+    def _task_streams(self) -> Dict[str, Any]:
+        """
+        One persistent CUDA stream per model-backed task, empty on CPU. The caching
+        allocator pools memory per stream, so reusing the same streams across calls
+        lets each task reuse its cached blocks instead of growing a new pool.
+        """
+        import torch
+
+        if not torch.cuda.is_available():
+            return {}
+        return {"sentiment": torch.cuda.Stream(), "soap": torch.cuda.Stream()}
+
+    @staticmethod
+    def _run_on_stream(stream: Any, task: Callable[..., Any], *args: Any) -> Any:
+        """Helper that runs a task on the given CUDA stream so concurrent model calls can overlap on one GPU."""
+        import torch
+
+        stream_context = torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+        with stream_context:
+            return task(*args)
+
     def run_full_analysis(self, transcript: str) -> Dict[str, Any]:
         """
         Runs the complete analysis pipeline on a given transcript.
+        The cheap rule-based summary runs first so the SOAP note can reuse it;
+        the two model-backed tasks then run concurrently.
         """
         summary = self.generate_medical_summary(transcript)
-        sentiment = self.analyze_sentiment_intent(transcript)
-        soap_note = self.generate_soap_note(transcript)
+        streams = self._task_streams
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            sentiment_future = executor.submit(
+                self._run_on_stream, streams.get("sentiment"), self.analyze_sentiment_intent, transcript
+            )
+            soap_future = executor.submit(
+                self._run_on_stream, streams.get("soap"), self.generate_soap_note, transcript, summary
+            )
+            sentiment = sentiment_future.result()
+            soap_note = soap_future.result()
 
         return {
             "Medical_Summary": summary,
@@ -152,7 +683,7 @@ class PhysicianNotetakerPipeline:
 # ==============================================================================
 
 if __name__ == "__main__":
-    # 1. Initialize the Unified Pipeline (this loads the models)
+    # 1. Initialize the Unified Pipeline (the models load on first use)
     nlp_pipeline = PhysicianNotetakerPipeline()
 
     # 2. Provide the full, user-defined input transcript HERE
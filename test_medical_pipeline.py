@@ -0,0 +1,331 @@
+import asyncio
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import medical_pipeline
+from medical_pipeline import DialogueSplit, PhysicianNotetakerPipeline
+
+
+SAMPLE_TRANSCRIPT = """
+Physician: Good morning, Ms. Jones. How are you feeling today?
+Patient: Good morning, doctor. I’m doing better, but I still have some discomfort now and then.
+Physician: What did you feel immediately after the accident?
+Patient: At first, I was just shocked. But then I realized I had hit my head on the steering wheel, and I could feel pain in my neck and back almost right away.
+Patient: Yes, I went to Moss Bank Accident and Emergency. They checked me over and said it was a whiplash injury, but they didn’t do any X-rays.
+Patient: The first four weeks were rough. My neck and back pain were really bad—I had trouble sleeping and had to take painkillers regularly. It started improving after that, but I had to go through ten sessions of physiotherapy to help with the stiffness and discomfort.
+Patient: It’s not constant, but I do get occasional backaches. It’s nothing like before, though.
+Physician: That’s encouraging. Let’s go ahead and do a physical examination to check your mobility and any lingering pain.
+[Physical Examination Conducted]
+Physician: Everything looks good. Your neck and back have a full range of movement, and there’s no tenderness or signs of lasting damage.
+Patient: That’s a relief!
+Physician: Given your progress, I’d expect you to make a full recovery within six months of the accident.
+"""
+
+SUMMARY_TRANSCRIPTS = [
+    SAMPLE_TRANSCRIPT,
+    # Matched only by the "pain in my.+back" pattern, not by any keyphrase
+    "Patient: I have had a dull pain in my lower back since Monday.",
+    "Patient: NECK PAIN and Painkillers, plus a WHIPLASH INJURY.",
+    "Patient: My back feels fine, but my pain is elsewhere.",
+    "",
+]
+
+
+def baseline_summary(transcript):
+    """The rule-based summary as originally written, one regex or substring test per rule."""
+    summary = {
+        "Patient_Name": "Ms. Jones",
+        "Symptoms": [],
+        "Diagnosis": "Not mentioned",
+        "Treatment": [],
+        "Current_Status": "Not mentioned",
+        "Prognosis": "Not mentioned"
+    }
+    if re.search(r"pain in my neck|neck pain", transcript, re.IGNORECASE): summary["Symptoms"].append("Neck pain")
+    if re.search(r"pain in my.+back|back pain", transcript, re.IGNORECASE): summary["Symptoms"].append("Back pain")
+    if re.search(r"hit my head", transcript, re.IGNORECASE): summary["Symptoms"].append("Head impact")
+    if "whiplash injury" in transcript.lower(): summary["Diagnosis"] = "Whiplash injury"
+    if "ten sessions of physiotherapy" in transcript.lower(): summary["Treatment"].append("10 physiotherapy sessions")
+    if "painkillers" in transcript.lower(): summary["Treatment"].append("Painkillers")
+    if "occasional backaches" in transcript.lower(): summary["Current_Status"] = "Occasional backaches"
+    if "full recovery within six months" in transcript.lower(): summary["Prognosis"] = "Full recovery expected within six months"
+    return summary
+
+
+@pytest.fixture
+def pipeline():
+    # No model is loaded until a model-backed task runs
+    return PhysicianNotetakerPipeline()
+
+
+@pytest.mark.parametrize("matcher", ["substring", "ahocorasick"])
+@pytest.mark.parametrize("transcript", SUMMARY_TRANSCRIPTS)
+def test_summary_matches_baseline_rules(pipeline, matcher, transcript):
+    if matcher == "ahocorasick":
+        if medical_pipeline.ahocorasick is None:
+            pytest.skip("pyahocorasick is not installed")
+        assert pipeline._summary_automaton is not None
+    else:
+        pipeline._summary_automaton = None
+    assert pipeline.generate_medical_summary(transcript) == baseline_summary(transcript)
+
+
+def test_summary_regex_only_rule(pipeline):
+    summary = pipeline.generate_medical_summary(SUMMARY_TRANSCRIPTS[1])
+    assert summary["Symptoms"] == ["Back pain"]
+
+
+@pytest.mark.parametrize("num_beams", [0, -1, 1.5])
+def test_rejects_invalid_num_beams(num_beams):
+    with pytest.raises(ValueError, match="num_beams"):
+        PhysicianNotetakerPipeline(num_beams=num_beams)
+
+
+@pytest.mark.parametrize("soap_backend", ["vllm", "vllm-async"])
+def test_vllm_backends_reject_beam_search(soap_backend):
+    with pytest.raises(ValueError, match="num_beams"):
+        PhysicianNotetakerPipeline(soap_backend=soap_backend, soap_model="some/decoder-model", num_beams=4)
+
+
+class StubChatTokenizer:
+    chat_template = "stub"
+
+    def apply_chat_template(self, messages, tokenize, add_generation_prompt):
+        assert not tokenize and add_generation_prompt
+        return f"<user>{messages[0]['content']}<assistant>"
+
+
+def test_apply_chat_template(pipeline):
+    pipeline.__dict__["_chat_tokenizer"] = StubChatTokenizer()
+    assert pipeline._apply_chat_template(["a", "b"]) == ["<user>a<assistant>", "<user>b<assistant>"]
+
+
+def test_apply_chat_template_without_template(pipeline):
+    pipeline.__dict__["_chat_tokenizer"] = object()
+    assert pipeline._apply_chat_template(["a"]) == ["a"]
+
+
+def test_prompts_share_the_preamble_and_context_part(pipeline):
+    contexts = {"patient": "patient lines", "physician": "physician lines", "both": "all lines"}
+    context_parts = {}
+    for point, (_, _, context_source, point_name, point_description) in enumerate(pipeline._SOAP_SKELETON, 1):
+        context_part, field_part = pipeline._build_prompt(point, point_name, point_description, contexts[context_source])
+        assert context_part.startswith(pipeline._SOAP_PROMPT_PREAMBLE)
+        assert point_name in field_part
+        # share_encoder encodes each distinct context part once, so it must not vary by field
+        assert context_parts.setdefault(context_source, context_part) == context_part
+    assert len(set(context_parts.values())) == len(contexts)
+
+
+@pytest.mark.parametrize("summary_field, expected", [
+    ("Symptoms", "Neck pain, Back pain"),
+    ("Treatment", None),
+    ("Diagnosis", "Whiplash injury"),
+    ("Prognosis", None),
+    ("Missing", None),
+])
+def test_summary_shortcut(pipeline, summary_field, expected):
+    summary = {
+        "Symptoms": ["Neck pain", "Back pain"],
+        "Treatment": [],
+        "Diagnosis": "Whiplash injury",
+        "Prognosis": "Not mentioned"
+    }
+    assert pipeline._summary_shortcut(summary, summary_field) == expected
+
+
+class StubGenerator:
+    """Stands in for the text2text pipeline and records which prompts reach it."""
+
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, prompts, **kwargs):
+        self.prompts.extend(prompts)
+        return [{"generated_text": f"generated {len(self.prompts) - len(prompts) + i}"} for i in range(len(prompts))]
+
+
+def generated_points(generator):
+    return [re.search(r"Point \d+: ([^.]+)\.", prompt).group(1) for prompt in generator.prompts]
+
+
+def test_soap_note_routes_fields_from_the_summary(pipeline):
+    generator = StubGenerator()
+    pipeline.__dict__["soap_generator"] = generator
+    summary = pipeline.generate_medical_summary(SAMPLE_TRANSCRIPT)
+    soap_note = pipeline.generate_soap_note(SAMPLE_TRANSCRIPT, summary)
+
+    assert generated_points(generator) == ["History of Present Illness", "Follow-Up Plan"]
+    assert soap_note["Subjective"] == {
+        "Chief_Complaint": "Neck pain, Back pain, Head impact",
+        "History_of_Present_Illness": "generated 0"
+    }
+    assert soap_note["Assessment"] == {
+        "Diagnosis": "Whiplash injury",
+        "Prognosis": "Full recovery expected within six months"
+    }
+    assert soap_note["Plan"] == {"Treatment": "10 physiotherapy sessions, Painkillers", "Follow-Up": "generated 1"}
+
+
+def test_soap_note_skips_fields_without_context(pipeline):
+    generator = StubGenerator()
+    pipeline.__dict__["soap_generator"] = generator
+    soap_note = pipeline.generate_soap_note("Patient: My neck hurts.")
+
+    assert generated_points(generator) == ["Chief Complaint", "History of Present Illness", "Treatment Plan"]
+    for section, field in [("Assessment", "Diagnosis"), ("Assessment", "Prognosis"), ("Plan", "Follow-Up")]:
+        assert soap_note[section][field] == "Not mentioned in the provided context."
+
+
+def test_extract_exam_findings(pipeline):
+    objective = PhysicianNotetakerPipeline._split_dialogue(SAMPLE_TRANSCRIPT).objective
+    assert pipeline._extract_exam_findings(objective) == (
+        "Everything looks good. Your neck and back have a full range of movement, "
+        "and there’s no tenderness or signs of lasting damage."
+    )
+
+
+def test_extract_exam_findings_truncates_on_a_word(pipeline):
+    objective = PhysicianNotetakerPipeline._split_dialogue(SAMPLE_TRANSCRIPT).objective
+    assert pipeline._extract_exam_findings(objective, max_chars=30) == "Everything looks good. Your..."
+
+
+def test_extract_exam_findings_without_exam(pipeline):
+    assert pipeline._extract_exam_findings("") == "Not mentioned in the provided context."
+
+
+def test_split_dialogue():
+    dialogue = PhysicianNotetakerPipeline._split_dialogue(SAMPLE_TRANSCRIPT)
+    assert isinstance(dialogue, DialogueSplit)
+    assert len(dialogue.patient) == 6
+    assert len(dialogue.physician) == 5
+    assert dialogue.patient[-1].strip() == "That’s a relief!"
+    assert dialogue.objective.startswith("Physician: Everything looks good.")
+    # Repeated transcripts are served from the cache
+    assert PhysicianNotetakerPipeline._split_dialogue(SAMPLE_TRANSCRIPT) is dialogue
+
+
+def test_split_dialogue_without_exam():
+    dialogue = PhysicianNotetakerPipeline._split_dialogue("Patient: Hello.\nPhysician: Hi.")
+    assert [line.strip() for line in dialogue.patient] == ["Hello."]
+    assert [line.strip() for line in dialogue.physician] == ["Hi."]
+    assert dialogue.objective == ""
+
+
+class StubAsyncEngine:
+    """
+    Stands in for vLLM's AsyncLLMEngine: each request streams one output after a
+    delay that shrinks with the point number, so later points finish first.
+    """
+
+    def __init__(self, failing_point=None):
+        self.failing_point = failing_point
+        self.started, self.finished, self.cancelled = [], [], []
+        self.lock = threading.Lock()
+
+    async def generate(self, prompt, sampling_params, request_id):
+        point = int(re.search(r"Point (\d+):", prompt).group(1))
+        with self.lock:
+            self.started.append(point)
+        try:
+            await asyncio.sleep(0.05 * (7 - point))
+        except asyncio.CancelledError:
+            with self.lock:
+                self.cancelled.append(point)
+            raise
+        if point == self.failing_point:
+            raise RuntimeError(f"point {point} failed")
+        with self.lock:
+            self.finished.append(point)
+        yield SimpleNamespace(outputs=[SimpleNamespace(text=f' "expanded {point}" ')])
+
+
+def async_pipeline(engine):
+    pipeline = PhysicianNotetakerPipeline()
+    # Switched after construction so the test needs neither vllm nor a GPU
+    pipeline.soap_backend = "vllm-async"
+    pipeline.__dict__.update(soap_generator=engine, soap_sampling_params=None, _chat_tokenizer=object())
+    return pipeline
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_astream_soap_fields_yields_in_completion_order():
+    engine = StubAsyncEngine()
+    pipeline = async_pipeline(engine)
+
+    async def collect():
+        return [item async for item in pipeline.astream_soap_fields(SAMPLE_TRANSCRIPT)]
+
+    items = asyncio.run(collect())
+    # The extracted Objective fields come first, then the generated fields as they finish
+    assert [field for _, field, _ in items[:2]] == ["Physical_Exam", "Observations"]
+    assert [text for _, _, text in items[2:]] == [f"expanded {point}" for point in range(6, 0, -1)]
+    assert [field for _, field, _ in items[2:]] == [spec[1] for spec in reversed(pipeline._SOAP_SKELETON)]
+
+
+def test_astream_soap_fields_cancels_requests_on_early_exit():
+    engine = StubAsyncEngine()
+    pipeline = async_pipeline(engine)
+
+    async def first_generated_field():
+        stream = pipeline.astream_soap_fields(SAMPLE_TRANSCRIPT)
+        async for _, _, text in stream:
+            if text.startswith("expanded"):
+                break
+        await stream.aclose()
+        return text
+
+    assert asyncio.run(first_generated_field()) == "expanded 6"
+    assert wait_for(lambda: len(engine.cancelled) == 5)
+    assert engine.finished == [6]
+
+
+def test_agenerate_soap_note_cancels_requests_when_one_fails():
+    engine = StubAsyncEngine(failing_point=6)
+    pipeline = async_pipeline(engine)
+
+    with pytest.raises(RuntimeError, match="point 6 failed"):
+        asyncio.run(pipeline.agenerate_soap_note(SAMPLE_TRANSCRIPT))
+    assert wait_for(lambda: len(engine.cancelled) == 5)
+    assert engine.finished == []
+
+
+class StubSentenceEncoder:
+    """Embeds each label as a one-hot vector and every line as the same fixed scores."""
+
+    def __init__(self, np, line_scores):
+        self.np, self.line_scores = np, line_scores
+        self.lines = []
+
+    def encode(self, text, normalize_embeddings=False):
+        if isinstance(text, list):
+            return self.np.eye(len(text))
+        self.lines.append(text)
+        return self.np.array(self.line_scores)
+
+
+def test_sentiment_and_intent_use_their_own_label_slices(pipeline):
+    np = pytest.importorskip("numpy")
+    # Scores over SENTIMENT_LABELS + INTENT_LABELS; the overall best score is an intent
+    # label, and the best sentiment and intent sit at different offsets in their slices
+    encoder = StubSentenceEncoder(np, [0.1, 0.0, 0.5, 0.2, 0.9, 0.1, 0.3])
+    pipeline.__dict__["sentence_encoder"] = encoder
+
+    result = pipeline.analyze_sentiment_intent(SAMPLE_TRANSCRIPT)
+
+    assert result["Sentiment"] == "Reassured"
+    assert result["Intent"] == "Seeking reassurance"
+    # The first patient line with an expressive keyword is the one classified
+    assert result["Analyzed_Line"].startswith("The first four weeks were rough.")
+    assert len(encoder.lines) == 1
+